@@ -2,48 +2,110 @@
 Written by Mengzhan Liufu at Yu Lab, the University of Chicago
 '''
 from trodes_connection import subscribe_to_data, connect_to_trodes
-# from data_buffering import data_buffering
-from detector import Detector
-import threading
+from detector import Detector, design_filter_coefficients, filter_signature
+from data_buffering import SharedRingBuffer, SharedArrays
+from phase_estimators import MultiWindowECHTEstimator
+import asyncio
 import multiprocessing as mp
 import argparse
+import atexit
 import json
-from collections import deque
+import zmq
 
 
-def detection_task(
-    detector_name, 
-    detector_param, 
-    shared_data_buffer, 
-    trodes_hardware
+def create_detector(
+    detector_name,
+    detector_param,
+    shared_data_buffer,
+    trodes_hardware,
+    filter_coefficients=None,
+    echt_batch=None
     ):
     # Extract required parameter without modifying original dict
     statescript_fxn_num = detector_param['statescript_fxn_num']
     detector_kwargs = {k: v for k, v in detector_param.items() if k != 'statescript_fxn_num'}
     
     # Create detector with all parameters
-    detector = Detector(
+    return Detector(
         detector_name,
         shared_data_buffer,
         statescript_fxn_num,
         trodes_hardware,
+        filter_coefficients=filter_coefficients,
+        echt_batch=echt_batch,
         **detector_kwargs
     )
-    detection_thread = threading.Thread(target=detector.closed_loop_stim)
-    detection_thread.start()
-    # detection_thread.join()
 
 
-def buffering_task(
+def detection_task(
+    detector_name, 
+    detector_param, 
+    data_buffer_name,
+    data_buffer_size,
+    filter_coefficients_spec,
+    trodes_hardware,
+    data_buffer_wakeup=None
+    ):
+    # Attach to the data buffer written by the main process, and to the filter
+    # coefficients it precomputed
+    shared_data_buffer = SharedRingBuffer(
+        data_buffer_size, name=data_buffer_name, wakeup=data_buffer_wakeup
+    )
+    shared_coefficients = SharedArrays(spec=filter_coefficients_spec)
+
+    detector = create_detector(
+        detector_name,
+        detector_param,
+        shared_data_buffer,
+        trodes_hardware,
+        shared_coefficients.arrays
+    )
+    asyncio.run(detector.closed_loop_stim())
+
+
+async def buffering_task(
         lfp_client, 
         shared_data_buffer, 
         target_channel, 
-        # buffer_lock
     ):
-    while True:
-        # with buffer_lock:
-        current_data = lfp_client.receive()['lfpData']
-        shared_data_buffer.append(current_data[target_channel])
+    loop = asyncio.get_running_loop()
+    # The zmq socket under the Trodes subscriber signals incoming messages on a file
+    # descriptor, so the event loop wakes this task only when samples are waiting
+    # and no thread sits blocked in receive
+    samples_ready = asyncio.Event()
+    fd = lfp_client.socket.socket.getsockopt(zmq.FD)
+    loop.add_reader(fd, samples_ready.set)
+    try:
+        while True:
+            samples_ready.clear()
+            # The descriptor only signals changes, so drain every queued sample
+            # before waiting again
+            new_samples = []
+            while True:
+                try:
+                    current_sample = lfp_client.receive(noblock=True)
+                except zmq.Again:
+                    break
+                new_samples.append(current_sample['lfpData'][target_channel])
+            if new_samples:
+                shared_data_buffer.extend(new_samples)
+            await samples_ready.wait()
+    finally:
+        loop.remove_reader(fd)
+
+
+async def closed_loop_task(
+        lfp_client,
+        shared_data_buffer,
+        target_channel,
+        detectors
+    ):
+    # Buffering and all in-process detectors share one event loop; stimulation commands
+    # are sent from a worker thread so a Trodes round trip does not stall it
+    await asyncio.gather(
+        buffering_task(lfp_client, shared_data_buffer, target_channel),
+        *[detector.closed_loop_stim() for detector in detectors]
+    )
 
 
 if __name__ == "__main__":
@@ -65,50 +127,72 @@ if __name__ == "__main__":
     )
 
     # ------------------------- Create and initialize shared data buffer -------------------------
-    shared_data_buffer = deque([], maxlen=params['data_buffer_size'])
-    # buffer_lock = threading.Lock()
+    shared_data_buffer = SharedRingBuffer(params['data_buffer_size'])
+    atexit.register(shared_data_buffer.unlink)
     for i in range(params['data_buffer_size']):
         current_sample = lfp_client.receive()
         current_data = current_sample['lfpData']
         shared_data_buffer.append(current_data[params['target_channel']])
 
-    # ------------------------- Start buffering data -------------------------
-    buffering_thread = threading.Thread(
-        target=buffering_task, 
-        args=(
-            lfp_client, 
-            shared_data_buffer, 
-            params['target_channel'], 
-            # buffer_lock
-        )
+    # ------------------------- Create detectors -------------------------
+    # By default all detectors run as tasks in this process; set single_process to false
+    # to give each detector its own process instead
+    single_process = params.get('single_process', True)
+    detectors = []
+    # In-process ecHT detectors are computed together, one matrix-vector product per distinct window size
+    num_echt = sum(
+        detector_param.get('method', 'ecHT').lower() == 'echt'
+        for detector_param in params['detector_params'].values()
     )
-    buffering_thread.start()
-
-    # ------------------------- Spawn detector processes -------------------------
-    # detection_process_lst = []
+    echt_batch = None
+    if single_process and num_echt > 1:
+        echt_batch = MultiWindowECHTEstimator(shared_data_buffer)
+    # Filter coefficients in shared memory, one block per distinct filter signature
+    shared_coefficients = {}
     for detector_name, detector_param in params['detector_params'].items():
 
         assert detector_param['window_size'] <= params['data_buffer_size'], (
             'Detector input window size must be smaller than data buffer size'
         )
 
-        new_detection_process = mp.Process(
-            target=detection_task,
-            args=(
+        if single_process:
+            detectors.append(create_detector(
                 detector_name,
                 detector_param,
                 shared_data_buffer,
-                trodes_hardware
+                trodes_hardware,
+                echt_batch=echt_batch
+            ))
+        else:
+            signature = filter_signature(detector_param)
+            if signature not in shared_coefficients:
+                shared_coefficients[signature] = SharedArrays(
+                    design_filter_coefficients(*signature)
+                )
+                atexit.register(shared_coefficients[signature].unlink)
+
+            # Signals the process when new samples arrive, so it does not poll
+            data_buffer_wakeup = shared_data_buffer.add_consumer()
+            new_detection_process = mp.Process(
+                target=detection_task,
+                args=(
+                    detector_name,
+                    detector_param,
+                    shared_data_buffer.name,
+                    params['data_buffer_size'],
+                    shared_coefficients[signature].spec,
+                    trodes_hardware,
+                    data_buffer_wakeup
+                )
             )
-        )
-        new_detection_process.start()
-        # detection_process_lst.append(new_detection_process)
-
-    # # Wait for all processes to complete
-    # for p in detection_process_lst:
-    #     p.join()
-
-    # # Ensure buffering thread is stopped gracefully (optional)
-    # buffering_thread.join()
-
+            new_detection_process.start()
+            # The child process holds its own copy of the wakeup pipe's read end
+            data_buffer_wakeup.close()
 
+    # ------------------------- Start buffering data and detection -------------------------
+    asyncio.run(closed_loop_task(
+        lfp_client,
+        shared_data_buffer,
+        params['target_channel'],
+        detectors
+    ))
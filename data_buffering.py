@@ -0,0 +1,321 @@
+"""
+Preallocated ring buffer for streaming LFP samples, and read-only arrays shared across processes
+Written by Mengzhan Liufu at Yu Lab, the University of Chicago
+"""
+
+import asyncio
+import os
+import weakref
+import multiprocessing as mp
+import numpy as np
+from multiprocessing.shared_memory import SharedMemory
+
+# Bytes reserved for the write index at the start of a shared buffer's memory block
+_INDEX_BYTES = 8
+# Alignment of each array packed into a SharedArrays block
+_ARRAY_ALIGNMENT = 64
+
+# Producer buffers with wakeup pipes. A forked consumer would otherwise inherit the write
+# ends of every pipe, including its own, and never see end of file when the producer exits
+_wakeup_producers = weakref.WeakSet()
+
+
+def _close_inherited_wakeup_senders():
+    for buffer in list(_wakeup_producers):
+        buffer._close_wakeup_senders()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_close_inherited_wakeup_senders)
+
+
+class RingBuffer:
+    """
+    Fixed-size ring buffer of samples backed by a numpy array
+
+    Samples default to float32: LFP comes from a 16-bit ADC, and single precision
+    halves the memory traffic of every window read.
+    """
+
+    def __init__(self, size, dtype=np.float32):
+        self.size = size
+        self.data = np.zeros(size, dtype=dtype)
+        # Total number of samples ever written; kept in an array so that
+        # every holder of the buffer sees the same write index
+        self.write_index = np.zeros(1, dtype=np.int64)
+        # Whether the producer runs in this process and can wake waiting consumers
+        self._local_producer = True
+        self._new_samples = None
+        # Set once a producer in another process is known to have exited
+        self._producer_closed = False
+
+    def __len__(self):
+        return self.size
+
+    def append(self, sample):
+        """Write one sample, overwriting the oldest one"""
+        idx = self.write_index[0]
+        self.data[idx % self.size] = sample
+        self.write_index[0] = idx + 1
+        self._notify()
+
+    def extend(self, samples):
+        """Write a chunk of samples, overwriting the oldest ones"""
+        idx = self.write_index[0]
+        # Only the last size samples survive a chunk longer than the buffer
+        skipped = max(len(samples) - self.size, 0)
+        kept = samples[skipped:]
+        start = (idx + skipped) % self.size
+        head = min(len(kept), self.size - start)
+        self.data[start:start + head] = kept[:head]
+        self.data[:len(kept) - head] = kept[head:]
+        self.write_index[0] = idx + len(samples)
+        self._notify()
+
+    def _notify(self):
+        """Wake consumers waiting in wait_for_samples"""
+        if self._new_samples is not None:
+            self._new_samples.set()
+            self._new_samples = None
+
+    async def wait_for_samples(self, read_index):
+        """
+        Wait until samples past read_index have been written
+
+        Always yields to the event loop at least once, so that the producer and
+        other consumers sharing the loop get to run. Consumers sleep until the next
+        write if they are in the producer's process or have a wakeup channel (see
+        SharedRingBuffer.add_consumer); other consumers busy-poll.
+
+        Parameters
+        ----------
+        read_index : int, write index the consumer has already read up to
+
+        Returns
+        -------
+        int, the current write index
+
+        Raises
+        ------
+        EOFError if no samples are left to read and the producer has exited
+        """
+        await asyncio.sleep(0)
+        while self.write_index[0] == read_index:
+            if self._producer_closed:
+                raise EOFError('The data buffer producer has exited')
+            if self._local_producer or self._watch_wakeup():
+                if self._new_samples is None:
+                    self._new_samples = asyncio.Event()
+                await self._new_samples.wait()
+            else:
+                await asyncio.sleep(0)
+        return self.write_index[0]
+
+    def _watch_wakeup(self):
+        """Arrange for writes from another process to wake this one; False if they cannot"""
+        return False
+
+    def latest(self, n, write_index=None):
+        """
+        Return the most recent n samples in chronological order
+
+        Parameters
+        ----------
+        n : int, number of samples, must not exceed the buffer size
+        write_index : int, optional snapshot of the write index to read up to,
+            defaults to the current one
+
+        Returns
+        -------
+        numpy array, a view into the buffer unless the samples wrap around;
+        views are overwritten as new samples arrive
+        """
+        if write_index is None:
+            write_index = self.write_index[0]
+        # End of the newest sample in [1, size], so an unwrapped tail is always a plain slice
+        end = (write_index - 1) % self.size + 1
+        start = end - n
+        if start >= 0:
+            return self.data[start:end]
+        return np.concatenate((self.data[start:], self.data[:end]))
+
+
+class SharedRingBuffer(RingBuffer):
+    """
+    RingBuffer whose samples and write index live in one shared memory block
+
+    Meant for a single producer process and any number of consumer processes.
+    The producer writes a sample before advancing the write index, so a consumer
+    that snapshots the write index only reads samples that are fully written.
+    After each write the producer also signals every consumer's wakeup pipe, so
+    consumers can sleep in the event loop instead of polling.
+    """
+
+    def __init__(self, size, dtype=np.float32, name=None, wakeup=None):
+        """
+        Parameters
+        ----------
+        size : int, number of samples in the buffer
+        dtype : numpy dtype of the samples
+        name : str, name of an existing shared buffer to attach to;
+            a new block is created if None
+        wakeup : multiprocessing Connection from add_consumer, optional;
+            without one, consumers attached by name busy-poll for new samples
+        """
+        self.size = size
+        self.dtype = np.dtype(dtype)
+        create = name is None
+        self.shm = SharedMemory(
+            name=name, create=create, size=_INDEX_BYTES + size * self.dtype.itemsize
+        )
+        self.write_index = np.ndarray((1,), dtype=np.int64, buffer=self.shm.buf)
+        self.data = np.ndarray(
+            (size,), dtype=self.dtype, buffer=self.shm.buf, offset=_INDEX_BYTES
+        )
+        if create:
+            self.write_index[0] = 0
+            self.data[:] = 0
+        # Processes that attach by name only consume; the creating process produces
+        self._local_producer = create
+        self._new_samples = None
+        self._producer_closed = False
+        # Producer side: write ends of the consumers' wakeup pipes
+        self._wakeup_senders = []
+        # Consumer side: read end of this process's wakeup pipe, and the loop watching it
+        self._wakeup = wakeup
+        self._wakeup_loop = None
+        if wakeup is not None:
+            os.set_blocking(wakeup.fileno(), False)
+
+    @property
+    def name(self):
+        """Name other processes pass to attach to this buffer"""
+        return self.shm.name
+
+    def add_consumer(self):
+        """
+        Create a wakeup channel for one consumer process; call from the producer
+
+        Returns
+        -------
+        multiprocessing Connection to pass to the consumer process, which attaches
+        with SharedRingBuffer(size, name=name, wakeup=connection)
+        """
+        receiver, sender = mp.Pipe(duplex=False)
+        # A full pipe already means "new samples", so writes never need to block
+        os.set_blocking(sender.fileno(), False)
+        self._wakeup_senders.append(sender)
+        _wakeup_producers.add(self)
+        return receiver
+
+    def _close_wakeup_senders(self):
+        """Close the write ends of the consumers' wakeup pipes"""
+        for sender in self._wakeup_senders:
+            sender.close()
+        self._wakeup_senders = []
+
+    def _notify(self):
+        """Wake consumers in this process and signal consumer processes"""
+        super()._notify()
+        for sender in self._wakeup_senders:
+            try:
+                os.write(sender.fileno(), b'\0')
+            except BlockingIOError:
+                pass
+
+    def _watch_wakeup(self):
+        """Watch the wakeup pipe from the running event loop; False without one"""
+        if self._wakeup is None:
+            return False
+        loop = asyncio.get_running_loop()
+        if self._wakeup_loop is not loop:
+            loop.add_reader(self._wakeup.fileno(), self._on_wakeup)
+            self._wakeup_loop = loop
+        return True
+
+    def _on_wakeup(self):
+        """Drain the wakeup pipe, which may hold several signals, and wake waiting consumers"""
+        try:
+            while os.read(self._wakeup.fileno(), 4096):
+                pass
+            # End of file: the producer has exited, so waiting consumers are woken to stop
+            self._wakeup_loop.remove_reader(self._wakeup.fileno())
+            self._wakeup.close()
+            self._wakeup = None
+            self._wakeup_loop = None
+            self._producer_closed = True
+        except BlockingIOError:
+            pass
+        self._notify()
+
+    def close(self):
+        """Detach this process from the shared block"""
+        # Views into the block must be released before it can be closed
+        self.data = None
+        self.write_index = None
+        if self._wakeup_loop is not None and not self._wakeup_loop.is_closed():
+            self._wakeup_loop.remove_reader(self._wakeup.fileno())
+        self._close_wakeup_senders()
+        if self._wakeup is not None:
+            self._wakeup.close()
+        self._wakeup = None
+        self._wakeup_loop = None
+        self.shm.close()
+
+    def unlink(self):
+        """Detach and free the shared block; call once, from the creating process"""
+        self.close()
+        self.shm.unlink()
+
+
+class SharedArrays:
+    """
+    Read-only numpy arrays packed into one shared memory block
+
+    The creating process copies the arrays in once; other processes attach with
+    the picklable spec and get zero-copy, read-only views of the same memory.
+    """
+
+    def __init__(self, arrays=None, spec=None):
+        """
+        Parameters
+        ----------
+        arrays : dict of name to numpy array, to copy into a new block
+        spec : tuple returned by the spec property of an existing block, to attach to
+        """
+        if spec is None:
+            layout = []
+            offset = 0
+            for key, array in arrays.items():
+                array = np.ascontiguousarray(array)
+                layout.append((key, array.dtype.str, array.shape, offset))
+                offset += -(-array.nbytes // _ARRAY_ALIGNMENT) * _ARRAY_ALIGNMENT
+            self.shm = SharedMemory(create=True, size=max(offset, 1))
+            self._layout = tuple(layout)
+        else:
+            name, self._layout = spec
+            self.shm = SharedMemory(name=name)
+
+        self.arrays = {}
+        for key, dtype, shape, offset in self._layout:
+            view = np.ndarray(shape, dtype=dtype, buffer=self.shm.buf, offset=offset)
+            if spec is None:
+                view[...] = arrays[key]
+            view.flags.writeable = False
+            self.arrays[key] = view
+
+    @property
+    def spec(self):
+        """Picklable description other processes pass to attach to this block"""
+        return self.shm.name, self._layout
+
+    def close(self):
+        """Detach this process from the shared block"""
+        # Views into the block must be released before it can be closed
+        self.arrays = None
+        self.shm.close()
+
+    def unlink(self):
+        """Detach and free the shared block; call once, from the creating process"""
+        self.close()
+        self.shm.unlink()
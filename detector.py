@@ -1,10 +1,165 @@
 '''
 Written by Mengzhan Liufu at Yu Lab, the University of Chicago
 '''
+import asyncio
+import inspect
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from scipy.signal import butter, cheby1, ellip
 import numpy as np
+from numba import njit
 from trodes_connection import call_statescript
-from phase_estimators import ECHTEstimator, HTEstimator, PMEstimator
+from phase_estimators import (
+    ECHTEstimator, HTEstimator, PMEstimator, AnalyticIIREstimator, analytic_bandpass_sos
+)
+
+
+# Stimulation commands are blocking round trips to Trodes, so they run off the event loop;
+# one worker, since all detectors in a process share the hardware's socket
+_stim_executor = ThreadPoolExecutor(max_workers=1)
+
+
+@lru_cache(maxsize=None)
+def design_filter_coefficients(method, filter_type, fltr_order, target_lowcut,
+                               target_highcut, fs_filter, window_size=None):
+    """
+    Design the filter coefficients used by a phase estimation method
+
+    Cached, so detectors in the same process with the same filter share one copy.
+    Arrays read on every estimate (ecHT kernels and SOS sections) are single
+    precision; ecHT's b and a stay double precision, since they are only used to
+    design the kernel. All arrays are read-only, so they can also be placed in
+    shared memory for detectors in other processes.
+
+    Parameters
+    ----------
+    method : str, phase estimation method
+    filter_type : str, 'butter', 'cheby1' or 'ellip'
+    fltr_order : int, filter order
+    target_lowcut, target_highcut : float, frequency band of interest in Hz
+    fs_filter : float, sampling rate in Hz
+    window_size : int, ecHT window length; unused by other methods
+
+    Returns
+    -------
+    dict of name to numpy array: 'b', 'a', 'kernel_re' and 'kernel_im' for ecHT, 'sos' otherwise
+    """
+    method = method.lower()
+    # Define filter parameters
+    Wn = np.array([target_lowcut, target_highcut]) / (fs_filter / 2)
+    rp, rs = 1, 40
+
+    if method == 'echt':
+        # For ecHT, use IIR filter coefficients
+        if filter_type == 'butter':
+            b, a = butter(fltr_order, Wn, btype='bandpass')
+        elif filter_type == 'cheby1':
+            b, a = cheby1(fltr_order, rp, Wn, btype='bandpass')
+        elif filter_type == 'ellip':
+            b, a = ellip(fltr_order, rp, rs, Wn, btype='bandpass')
+        else:
+            raise ValueError(f"Unknown filter type: {filter_type}")
+
+        # The estimator only reads the endpoint kernel per sample, so that is what is shared
+        kernel_re, kernel_im = ECHTEstimator.endpoint_kernels(b, a, fs_filter, window_size)
+        coefficients = {
+            'b': b,
+            'a': a,
+            'kernel_re': kernel_re,
+            'kernel_im': kernel_im,
+        }
+
+    elif method in ['ht', 'hilbert', 'pm']:
+        # For HT and PM, use SOS filter
+        if filter_type == 'butter':
+            sos = butter(fltr_order, Wn, btype='bandpass', output='sos')
+        elif filter_type == 'cheby1':
+            sos = cheby1(fltr_order, rp, Wn, btype='bandpass', output='sos')
+        elif filter_type == 'ellip':
+            sos = ellip(fltr_order, rp, rs, Wn, btype='bandpass', output='sos')
+        else:
+            raise ValueError(f"Unknown filter type: {filter_type}")
+
+        coefficients = {'sos': sos.astype(np.float32)}
+
+    elif method in ['aiir', 'analytic_iir']:
+        # For analytic IIR, shift a lowpass prototype of half the band's width to the band center
+        Wn_half = (target_highcut - target_lowcut) / fs_filter
+        if filter_type == 'butter':
+            z, p, k = butter(fltr_order, Wn_half, btype='lowpass', output='zpk')
+        elif filter_type == 'cheby1':
+            z, p, k = cheby1(fltr_order, rp, Wn_half, btype='lowpass', output='zpk')
+        elif filter_type == 'ellip':
+            z, p, k = ellip(fltr_order, rp, rs, Wn_half, btype='lowpass', output='zpk')
+        else:
+            raise ValueError(f"Unknown filter type: {filter_type}")
+
+        w0 = np.pi * (target_lowcut + target_highcut) / fs_filter
+        coefficients = {'sos': analytic_bandpass_sos(z, p, k, w0).astype(np.complex64)}
+
+    else:
+        raise ValueError(f"Unknown phase estimation method: {method}")
+
+    for array in coefficients.values():
+        array.flags.writeable = False
+    return coefficients
+
+
+def filter_signature(detector_param):
+    """
+    Arguments of design_filter_coefficients for a detector's parameters
+
+    Missing parameters take Detector's defaults. Detectors with equal signatures
+    can share their filter coefficients.
+
+    Parameters
+    ----------
+    detector_param : dict of Detector keyword arguments
+
+    Returns
+    -------
+    tuple of arguments for design_filter_coefficients
+    """
+    param = {
+        name: parameter.default
+        for name, parameter in inspect.signature(Detector).parameters.items()
+    }
+    param.update(detector_param)
+    method = param['method'].lower()
+    return (
+        method,
+        param['filter_type'],
+        param['fltr_order'],
+        param['target_lowcut'],
+        param['target_highcut'],
+        param['fs_filter'],
+        param['window_size'] if method == 'echt' else None,
+    )
+
+
+@njit(cache=True)
+def _decide_stim(curr_phase, prev_phase, target_phase, stim_ok, rearm, rearm_on_wrap):
+    """
+    Update stimulation readiness and decide whether to stimulate, compiled with numba
+
+    Parameters
+    ----------
+    curr_phase, prev_phase : float, current and previous phase estimates
+    target_phase : float, phase at which to stimulate
+    stim_ok : bool, whether stimulation is armed
+    rearm : bool, re-arm regardless of phase (PM troughs)
+    rearm_on_wrap : bool, re-arm at phase wrapping (troughs) for ecHT, HT and AIIR
+
+    Returns
+    -------
+    tuple of (stim_ok, should_stim)
+    """
+    if rearm or (rearm_on_wrap and (prev_phase - curr_phase) > np.pi):
+        stim_ok = True
+    should_stim = stim_ok and curr_phase >= target_phase
+    if should_stim:
+        stim_ok = False
+    return stim_ok, should_stim
 
 
 class Detector:
@@ -33,13 +188,19 @@ class Detector:
         reset_threshold = 250,
         lock_on = False,
         lockdown = 50,
+        # Precomputed output of design_filter_coefficients, e.g. attached from shared memory
+        filter_coefficients = None,
+        # MultiWindowECHTEstimator on the same data buffer, to compute ecHT together with other detectors
+        echt_batch = None,
     ):
         self.name = detector_name
-        print(f'Starting new process for {detector_name}')
+        print(f'Starting detector {detector_name}')
 
         # For online filtering
         self.data_buffer = data_buffer
         self.window_size = window_size
+        # Number of buffered samples this detector has already seen
+        self.read_index = data_buffer.write_index[0]
         assert self.window_size <= len(data_buffer), (
             'Detector input window size must be smaller than data buffer size'
         )
@@ -52,6 +213,11 @@ class Detector:
 
         self.fs_filter = fs_filter
         self.method = method.lower()
+        self.echt_batch = echt_batch
+        if echt_batch is not None:
+            assert echt_batch.data_buffer is data_buffer, (
+                'Batched ecHT must read from the detector\'s data buffer'
+            )
         
         # For issuing stimulation command to trodes
         self.trodes_hardware = trodes_hardware
@@ -63,107 +229,123 @@ class Detector:
             'Target phase must be within [0, 2pi]'
         )
 
-        self.curr_phase = None
-        self.prev_phase = None
+        # NaN until the first estimate, so no phase comparison passes
+        self.curr_phase = np.nan
+        self.prev_phase = np.nan
         self.stim_ok = True
 
         # Initialize phase estimator based on method
+        if filter_coefficients is None:
+            filter_coefficients = design_filter_coefficients(*filter_signature(dict(
+                method=method,
+                filter_type=filter_type,
+                fltr_order=fltr_order,
+                target_lowcut=target_lowcut,
+                target_highcut=target_highcut,
+                fs_filter=fs_filter,
+                window_size=window_size,
+            )))
         self._initialize_phase_estimator(
-            method, filter_type, fltr_order, target_lowcut, target_highcut, 
-            fs_filter, regr_buffer_size, num_to_wait, derv_bar, default_slope,
-            gradient_factor, reset_on, reset_threshold, lock_on, lockdown
+            method, filter_coefficients, fs_filter, regr_buffer_size, num_to_wait,
+            derv_bar, default_slope, gradient_factor, reset_on, reset_threshold,
+            lock_on, lockdown
         )
 
-    def _initialize_phase_estimator(self, method, filter_type, fltr_order, 
-                                   target_lowcut, target_highcut, fs_filter,
+        # Causal filters (HT, PM and AIIR) start on the whole buffered history rather than
+        # one window, so their startup transient has died out before the first estimate
+        if self.method != 'echt':
+            self.phase_estimator.estimate_phase(
+                self.data_buffer.latest(len(self.data_buffer), self.read_index),
+                num_new=len(self.data_buffer)
+            )
+
+    def _initialize_phase_estimator(self, method, filter_coefficients, fs_filter,
                                    regr_buffer_size, num_to_wait, derv_bar, 
                                    default_slope, gradient_factor, reset_on, 
                                    reset_threshold, lock_on, lockdown):
         """Initialize the appropriate phase estimator based on method"""        
-        # Define filter parameters
-        Wn = np.array([target_lowcut, target_highcut]) / (fs_filter / 2)
-        rp, rs = 1, 40
-        
-        if method.lower() == 'echt':
-            # For ecHT, use IIR filter coefficients
-            if filter_type == 'butter':
-                b, a = butter(fltr_order, Wn, btype='bandpass')
-            elif filter_type == 'cheby1':
-                b, a = cheby1(fltr_order, rp, Wn, btype='bandpass')
-            elif filter_type == 'ellip':
-                b, a = ellip(fltr_order, rp, rs, Wn, btype='bandpass')
-            else:
-                raise ValueError(f"Unknown filter type: {filter_type}")
-            
-            self.phase_estimator = ECHTEstimator(b, a, fs_filter)
+        # Causal filters are phase compensated at the center of the band
+        center_freq = (self.target_lowcut + self.target_highcut) / 2
+        if method.lower() == 'echt' and self.echt_batch is not None:
+            self.phase_estimator = self.echt_batch.add(
+                filter_coefficients['b'],
+                filter_coefficients['a'],
+                fs_filter,
+                self.window_size,
+                kernel_re=filter_coefficients['kernel_re'],
+                kernel_im=filter_coefficients['kernel_im']
+            )
+
+        elif method.lower() == 'echt':
+            self.phase_estimator = ECHTEstimator(
+                filter_coefficients['b'],
+                filter_coefficients['a'],
+                fs_filter,
+                self.window_size,
+                kernel_re=filter_coefficients['kernel_re'],
+                kernel_im=filter_coefficients['kernel_im']
+            )
             
         elif method.lower() in ['ht', 'hilbert']:
-            # For HT, use SOS filter
-            if filter_type == 'butter':
-                sos = butter(fltr_order, Wn, btype='bandpass', output='sos')
-            elif filter_type == 'cheby1':
-                sos = cheby1(fltr_order, rp, Wn, btype='bandpass', output='sos')
-            elif filter_type == 'ellip':
-                sos = ellip(fltr_order, rp, rs, Wn, btype='bandpass', output='sos')
-            else:
-                raise ValueError(f"Unknown filter type: {filter_type}")
+            self.phase_estimator = HTEstimator(
+                filter_coefficients['sos'], self.window_size, center_freq, fs_filter
+            )
             
-            self.phase_estimator = HTEstimator(sos)
+        elif method.lower() in ['aiir', 'analytic_iir']:
+            self.phase_estimator = AnalyticIIREstimator(filter_coefficients['sos'])
             
         elif method.lower() == 'pm':
-            # For PM, use SOS filter
-            if filter_type == 'butter':
-                sos = butter(fltr_order, Wn, btype='bandpass', output='sos')
-            elif filter_type == 'cheby1':
-                sos = cheby1(fltr_order, rp, Wn, btype='bandpass', output='sos')
-            elif filter_type == 'ellip':
-                sos = ellip(fltr_order, rp, rs, Wn, btype='bandpass', output='sos')
-            else:
-                raise ValueError(f"Unknown filter type: {filter_type}")
-            
             self.phase_estimator = PMEstimator(
-                sos, regr_buffer_size, num_to_wait, derv_bar, default_slope,
-                gradient_factor, reset_on, reset_threshold, lock_on, lockdown
+                filter_coefficients['sos'], center_freq, fs_filter, regr_buffer_size, num_to_wait, derv_bar,
+                default_slope, gradient_factor, reset_on, reset_threshold, lock_on, lockdown
             )
         else:
             raise ValueError(f"Unknown phase estimation method: {method}")
 
     def update_curr_phase(self):
         """Update current phase using the selected phase estimation method"""
-        data_window = list(self.data_buffer)[-self.window_size:]
+        # Snapshot the write index so the window and the new sample count agree
+        write_index = self.data_buffer.write_index[0]
+        num_new = write_index - self.read_index
+        self.read_index = write_index
+
+        # Batched ecHT reads its windows from the buffer itself
+        if self.echt_batch is not None and self.method == 'echt':
+            data_window = None
+        else:
+            data_window = self.data_buffer.latest(self.window_size, write_index)
         self.prev_phase = self.curr_phase
-        self.curr_phase = self.phase_estimator.estimate_phase(data_window)
-
-    def update_stim_ok(self):
-        """Update stimulation readiness based on phase crossing detection"""
-        try:
-            # For PM method, stim_ok is handled internally by the estimator
-            if self.method == 'pm':
-                # PM method resets stim_ok at phase = 0 (trough)
-                if hasattr(self.phase_estimator, 'curr_sign') and not self.phase_estimator.curr_sign:
-                    self.stim_ok = True
-            else:
-                # For ecHT and HT methods, reset stim_ok at phase wrapping (troughs)
-                if (self.prev_phase - self.curr_phase) > np.pi:
-                    self.stim_ok = True
-        except (TypeError, AttributeError):
-            pass
-
-    def closed_loop_stim(self):
+        self.curr_phase = float(self.phase_estimator.estimate_phase(
+            data_window, num_new=num_new, write_index=write_index
+        ))
+
+    async def closed_loop_stim(self):
         """Main loop for closed-loop phase-locked stimulation"""
+        # PM re-arms at its own troughs, other methods at phase wrapping
+        rearm_on_wrap = self.method != 'pm'
+        loop = asyncio.get_running_loop()
         while True:
-            self.update_curr_phase()
-            self.update_stim_ok()
-
+            # Sleep until new samples arrive instead of re-estimating on the same window;
+            # samples that arrived together are handled in a single estimate
             try:
-                if self.curr_phase >= self.target_phase and self.stim_ok:
-                    print(f'{self.name} STIM at phase {self.curr_phase:.3f} using {self.method.upper()}')
-                    call_statescript(
-                        self.trodes_hardware, 
-                        self.statescript_fxn_num
-                    )
-                    self.stim_ok = False
-            except TypeError:
-                # curr_phase is None initially
-                pass
+                await self.data_buffer.wait_for_samples(self.read_index)
+            except EOFError:
+                print(f'{self.name} stopping: data buffering has ended')
+                return
+            self.update_curr_phase()
 
+            rearm = not rearm_on_wrap and not self.phase_estimator.curr_sign
+            self.stim_ok, should_stim = _decide_stim(
+                self.curr_phase, self.prev_phase, self.target_phase, self.stim_ok,
+                rearm, rearm_on_wrap
+            )
+            if should_stim:
+                print(f'{self.name} STIM at phase {self.curr_phase:.3f} using {self.method.upper()}')
+                # Not awaited: this detector keeps estimating on every sample, so it does not
+                # miss the next trough while Trodes answers, and buffering keeps running
+                loop.run_in_executor(
+                    _stim_executor,
+                    call_statescript,
+                    self.trodes_hardware,
+                    self.statescript_fxn_num
+                )
@@ -3,9 +3,12 @@ Phase estimation methods for real-time phase detection
 Written by Mengzhan Liufu at Yu Lab, the University of Chicago
 """
 
+import math
 import numpy as np
 from abc import ABC, abstractmethod
-from scipy.signal import hilbert, sosfiltfilt, freqz
+from scipy.signal import hilbert, sosfilt, sosfilt_zi, sosfreqz, freqz
+from numba import njit
+from data_buffering import RingBuffer
 
 
 class PhaseEstimator(ABC):
@@ -17,93 +20,455 @@ class PhaseEstimator(ABC):
         pass
 
 
+@njit(cache=True, fastmath=True)
+def _echt_endpoint_phase(window, kernel_re, kernel_im):
+    """
+    Phase of the last ecHT analytic sample as a dot product, compiled with numba
+
+    fastmath lets the two accumulations be reordered and vectorized with SIMD.
+
+    Parameters
+    ----------
+    window : float array, input signal of length n
+    kernel_re, kernel_im : float32 arrays, real and imaginary parts of
+        ECHTEstimator.endpoint_kernel
+
+    Returns
+    -------
+    float, phase in [0, 2pi]
+    """
+    re = 0.0
+    im = 0.0
+    for t in range(window.shape[0]):
+        re += window[t] * kernel_re[t]
+        im += window[t] * kernel_im[t]
+    return math.atan2(im, re) + math.pi
+
+
 class ECHTEstimator(PhaseEstimator):
     """Endpoint-Correcting Hilbert Transform phase estimator"""
     
-    def __init__(self, numerator, denominator, fs):
+    def __init__(self, numerator, denominator, fs, n, kernel_re=None, kernel_im=None):
         self.numerator = numerator
         self.denominator = denominator
         self.fs = fs
+        self.n = n
+
+        # The last analytic sample is linear in the window, so the phase estimate
+        # reduces to one dot product instead of a forward and an inverse FFT. The
+        # kernel only depends on the filter and window length, so compute it once,
+        # unless it was precomputed; precomputed kernels are used in place, so
+        # estimators (also in other processes) can read one shared copy
+        if kernel_re is None or kernel_im is None:
+            kernel_re, kernel_im = self.endpoint_kernels(numerator, denominator, fs, n)
+        self._kernel_re = kernel_re
+        self._kernel_im = kernel_im
     
-    def _echt(self, xr, b, a, Fs, n=None):
+    @staticmethod
+    def frequency_response(numerator, denominator, fs, n):
         """
-        Endpoint-correcting hilbert transform
-        
+        One-sided ecHT filter response for a window of length n
+
         Parameters
         ----------
-        xr: array like, input signal
-        b: numerators of IIR filter response
-        a: denominator of IIR filter response
-        Fs: signal sampling rate
-        n: length parameter
-        
+        numerator: numerators of IIR filter response
+        denominator: denominator of IIR filter response
+        fs: signal sampling rate
+        n: window length
+
         Returns
         -------
-        analytic signal
-        """
-        # Check input
-        if n is None:
-            n = len(xr)
-        if not all(np.isreal(xr)):
-            xr = np.real(xr)
-
-        # Compute FFT
-        x = np.fft.fft(xr, n)
-
-        # Set negative components to zero and multiply positive by 2 (apart from DC and Nyquist frequency)
-        h = np.zeros(n, dtype=x.dtype)
-        if n > 0 and 2 * (n // 2) == n:
-            # even and non-empty
-            h[[0, n // 2]] = 1
-            h[1:n // 2] = 2
-        elif n > 0:
-            # odd and non-empty
-            h[0] = 1
-            h[1:(n + 1) // 2] = 2
-        x = x * h
-
-        # Compute filter's frequency response
-        T = 1 / Fs * n
+        complex64 array of the n // 2 + 1 non-negative frequency bins
+        """
+        # Multiply positive frequencies by 2 (apart from DC and Nyquist frequency); negative
+        # frequencies are zeroed by the ecHT, so only the n // 2 + 1 non-negative bins are kept
+        h = np.full(n // 2 + 1, 2.0)
+        h[0] = 1
+        if n % 2 == 0:
+            h[-1] = 1
+
+        # Stored in unshifted (FFT) order so no fftshift / ifftshift is needed per call
+        T = 1 / fs * n
         filt_freq = np.ceil(np.arange(-n/2, n/2)) / T
-        filt_coeff = freqz(b, a, worN=filt_freq, fs=Fs)
+        filt_coeff = freqz(numerator, denominator, worN=filt_freq, fs=fs)
+        return (h * np.fft.ifftshift(filt_coeff[1])[:n // 2 + 1]).astype(np.complex64)
 
-        # Multiply FFT by filter's response function
-        x = np.fft.fftshift(x)
-        x = x * filt_coeff[1]
-        x = np.fft.ifftshift(x)
+    @staticmethod
+    def endpoint_kernel(response, n):
+        """
+        Weights that map a window of length n to the last sample of its ecHT
+
+        The last sample of ifft(S) is sum_k S_k exp(2j pi k (n - 1) / n) / n, and S is the
+        rfft of the window times the response, so the last sample equals
+        sum_t window[t] * kernel[t] with kernel the reversed IFFT of the zero-padded response.
+
+        Parameters
+        ----------
+        response: one-sided filter response from frequency_response
+        n: window length
+
+        Returns
+        -------
+        complex128 array of length n
+        """
+        spectrum = np.zeros(n, dtype=np.complex128)
+        spectrum[:len(response)] = response
+        return np.fft.ifft(spectrum)[::-1]
+
+    @classmethod
+    def endpoint_kernels(cls, numerator, denominator, fs, n):
+        """
+        Real and imaginary parts of the endpoint kernel of an IIR filter
+
+        Parameters
+        ----------
+        numerator: numerators of IIR filter response
+        denominator: denominator of IIR filter response
+        fs: signal sampling rate
+        n: window length
+
+        Returns
+        -------
+        tuple of two contiguous float32 arrays of length n
+        """
+        kernel = cls.endpoint_kernel(cls.frequency_response(numerator, denominator, fs, n), n)
+        return (
+            np.ascontiguousarray(kernel.real, dtype=np.float32),
+            np.ascontiguousarray(kernel.imag, dtype=np.float32),
+        )
 
-        # IFFT
-        x = np.fft.ifft(x)
-        return x
-    
     def estimate_phase(self, data_window, **kwargs):
         """Estimate phase using ecHT method"""
-        analytic_signal = self._echt(
-            data_window, 
-            self.numerator, 
-            self.denominator, 
-            self.fs
+        window = np.real(data_window)
+        assert len(window) == self.n, 'ecHT input must be exactly one window long'
+        return _echt_endpoint_phase(window, self._kernel_re, self._kernel_im)
+
+
+class _ECHTWindowGroup:
+    """ecHT of one window length under several filter responses"""
+
+    def __init__(self, n):
+        self.n = n
+        # One ECHTEstimator endpoint kernel per row
+        self.kernels = np.empty((0, n), dtype=np.complex64)
+        self.phases = np.empty(0)
+
+    def add(self, kernel_re, kernel_im):
+        """Add a filter's endpoint kernel and return its row in the batch"""
+        kernel = np.asarray(kernel_re) + 1j * np.asarray(kernel_im)
+        self.kernels = np.vstack((self.kernels, kernel)).astype(np.complex64)
+        self.phases = np.empty(len(self.kernels))
+        return len(self.kernels) - 1
+
+    def estimate(self, xr):
+        """Phase of the last sample of xr under every filter response"""
+        # The window is the same for every filter, so all last analytic samples
+        # come out of one matrix-vector product
+        analytic_endpoints = self.kernels @ np.real(xr)
+        self.phases[:] = np.angle(analytic_endpoints) + np.pi
+
+
+class _BatchedECHTEstimator(PhaseEstimator):
+    """One detector's view of a MultiWindowECHTEstimator"""
+
+    def __init__(self, batch, n, row):
+        self._batch = batch
+        self.n = n
+        self._row = row
+
+    def estimate_phase(self, data_window, write_index=None, **kwargs):
+        """Estimate phase using ecHT method; the window is read from the batch's buffer"""
+        return self._batch.phase(self.n, self._row, write_index)
+
+
+class MultiWindowECHTEstimator:
+    """
+    ecHT for several detectors that read the same ring buffer, computed as one batch
+
+    Detectors typically differ only in window length and filter. All estimates for a
+    write index are computed by whichever detector asks first, with one matrix-vector
+    product per distinct window length; the other detectors then reuse the result.
+    """
+
+    def __init__(self, data_buffer):
+        """
+        Parameters
+        ----------
+        data_buffer : RingBuffer the detectors read from
+        """
+        self.data_buffer = data_buffer
+        self._groups = {}
+        self._write_index = None
+
+    def add(self, numerator, denominator, fs, n, kernel_re=None, kernel_im=None):
+        """
+        Add a detector's filter and window length to the batch
+
+        Parameters
+        ----------
+        numerator: numerators of IIR filter response
+        denominator: denominator of IIR filter response
+        fs: signal sampling rate
+        n: window length
+        kernel_re, kernel_im: precomputed ECHTEstimator.endpoint_kernels, optional
+
+        Returns
+        -------
+        PhaseEstimator for the detector
+        """
+        assert n <= len(self.data_buffer), (
+            'ecHT window size must be smaller than data buffer size'
         )
-        return np.angle(analytic_signal)[-1] + np.pi
+        if kernel_re is None or kernel_im is None:
+            kernel_re, kernel_im = ECHTEstimator.endpoint_kernels(numerator, denominator, fs, n)
+        if n not in self._groups:
+            self._groups[n] = _ECHTWindowGroup(n)
+        group = self._groups[n]
+        # Force recomputation so the new detector is included
+        self._write_index = None
+        return _BatchedECHTEstimator(self, n, group.add(kernel_re, kernel_im))
+
+    def phase(self, n, row, write_index=None):
+        """
+        Phase estimate of one detector at a write index
+
+        Parameters
+        ----------
+        n : int, the detector's window length
+        row : int, the detector's row in its window length group
+        write_index : int, optional snapshot of the buffer's write index,
+            defaults to the current one
+
+        Returns
+        -------
+        float, phase in [0, 2pi]
+        """
+        if write_index is None:
+            write_index = self.data_buffer.write_index[0]
+        if write_index != self._write_index:
+            for length, group in self._groups.items():
+                group.estimate(self.data_buffer.latest(length, write_index))
+            self._write_index = write_index
+        return self._groups[n].phases[row]
+
+
+def _passband_phase_lag(sos, center_freq, fs):
+    """
+    Phase lag of a causal SOS filter at the center of its passband
+
+    A single causal pass (unlike the zero-phase sosfiltfilt) shifts the phase of the
+    filtered oscillation by the angle of the filter response. For a narrow band filter
+    this is close to constant across the band, so it is compensated as a fixed offset.
+    It is read at the band center rather than at the peak gain, which for cheby1 and
+    ellip filters is a ripple peak near a band edge.
+
+    Parameters
+    ----------
+    sos : array like, second-order sections of the filter
+    center_freq : float, center of the passband in Hz
+    fs : float, sampling rate in Hz
+
+    Returns
+    -------
+    float, phase lag in radians
+    """
+    _, response = sosfreqz(sos, worN=[center_freq], fs=fs)
+    return -np.angle(response[0])
+
+
+class _StreamingSOSFilter:
+    """Causal SOS filter that keeps its state between calls"""
+
+    def __init__(self, sos):
+        # Single precision sections, complex if the filter is; always a private copy since
+        # sosfilt needs writable sections and the given ones may be shared and read-only
+        self.sos = np.array(sos, dtype=np.complex64 if np.iscomplexobj(sos) else np.float32)
+        # Steady-state filter state for a unit step, scaled to the signal level on the first call
+        self._zi_step = sosfilt_zi(self.sos).astype(self.sos.dtype)
+        self.zi = None
+
+    def filter_new(self, data_window, num_new):
+        """
+        Filter the samples that arrived since the previous call
+
+        Parameters
+        ----------
+        data_window : array like, most recent input samples
+        num_new : int, number of samples at the end of data_window not filtered yet
+
+        Returns
+        -------
+        numpy array, filtered samples; the whole window on the first call
+        """
+        data_window = np.asarray(data_window, dtype=np.float32)
+        if self.zi is None:
+            # Start in steady state for the window's mean level, so its offset does not ring
+            # through the filter, then warm up the filter state on the whole first window
+            filtered, self.zi = sosfilt(
+                self.sos, data_window, zi=self._zi_step * np.mean(data_window)
+            )
+            return filtered
+        num_new = min(num_new, len(data_window))
+        if num_new == 0:
+            return data_window[:0]
+        filtered, self.zi = sosfilt(self.sos, data_window[-num_new:], zi=self.zi)
+        return filtered
 
 
 class HTEstimator(PhaseEstimator):
     """Standard Hilbert Transform phase estimator"""
     
-    def __init__(self, sos):
+    def __init__(self, sos, n, center_freq, fs):
         self.sos = sos
+        self.n = n
+        self.phase_lag = _passband_phase_lag(sos, center_freq, fs)
+        self._filter = _StreamingSOSFilter(sos)
+        # Last n filtered samples, so each call only filters what is new
+        self._filtered_history = RingBuffer(n)
+        self._curr_phase = None
     
-    def estimate_phase(self, data_window, **kwargs):
+    def estimate_phase(self, data_window, num_new=1, **kwargs):
         """Estimate phase using standard HT method"""
-        filtered = sosfiltfilt(self.sos, data_window)
-        analytic_signal = hilbert(filtered)
-        return np.angle(analytic_signal)[-1] + np.pi
+        filtered = self._filter.filter_new(data_window, num_new)
+        if len(filtered) == 0:
+            return self._curr_phase
+        self._filtered_history.extend(filtered)
+
+        z = hilbert(self._filtered_history.latest(self.n))[-1]
+        self._curr_phase = (math.atan2(z.imag, z.real) + math.pi + self.phase_lag) % (2 * math.pi)
+        return self._curr_phase
+
+
+def analytic_bandpass_sos(z, p, k, w0):
+    """
+    Turn a real lowpass prototype into a one-sided complex bandpass filter
+
+    Rotating the zeros and poles by w0 moves the passband to +w0 only, so the
+    output of the filter is (approximately) the analytic signal of the band.
+
+    Parameters
+    ----------
+    z, p, k : zeros, poles and gain of a digital lowpass filter, whose cutoff
+        is half the width of the target band
+    w0 : float, band center in radians per sample
+
+    Returns
+    -------
+    sos : complex array of second-order sections, with unit gain and zero phase at w0
+    """
+    rotation = np.exp(1j * w0)
+    z = np.asarray(z) * rotation
+    p = np.asarray(p) * rotation
+    n_sections = (max(len(z), len(p)) + 1) // 2
+    # Pad with roots at the origin so every section has two zeros and two poles
+    z = np.concatenate([z, np.zeros(2 * n_sections - len(z))])
+    p = np.concatenate([p, np.zeros(2 * n_sections - len(p))])
+
+    sos = np.zeros((n_sections, 6), dtype=complex)
+    for i in range(n_sections):
+        sos[i, :3] = np.poly(z[2 * i:2 * i + 2])
+        sos[i, 3:] = np.poly(p[2 * i:2 * i + 2])
+    sos[0, :3] *= k
+
+    # Normalize the response at the band center
+    z_inv = np.exp(-1j * w0) ** np.arange(3)
+    response = np.prod(sos[:, :3].dot(z_inv) / sos[:, 3:].dot(z_inv))
+    sos[0, :3] /= response
+    return sos
+
+
+class AnalyticIIREstimator(PhaseEstimator):
+    """Complex-coefficient IIR phase estimator, producing the analytic signal causally"""
+
+    def __init__(self, sos):
+        self.sos = sos
+        self._filter = _StreamingSOSFilter(sos)
+        self._curr_phase = None
+
+    def estimate_phase(self, data_window, num_new=1, **kwargs):
+        """Estimate phase from the newest sample of the complex filter output"""
+        analytic_signal = self._filter.filter_new(data_window, num_new)
+        if len(analytic_signal) == 0:
+            return self._curr_phase
+        z = analytic_signal[-1]
+        self._curr_phase = math.atan2(z.imag, z.real) + math.pi
+        return self._curr_phase
+
+
+# Sentinel for a PM sample count that has not been initialized by a critical point yet
+_NO_SAMPLE_COUNT = -1
+
+
+@njit(cache=True)
+def _pm_update(curr_derv, curr_sign, sample_count, slope, in_lock, sign_mask, full_mask,
+               derv_bar, gradient_factor, reset_on, reset_threshold, lock_on, lockdown):
+    """
+    One Phase Mapping state update, compiled with numba
+
+    Parameters
+    ----------
+    curr_derv : float, derivative of the filtered signal at the current sample
+    curr_sign : int, 1 while waiting for a peak, 0 while waiting for a trough
+    sample_count : int, samples since the last critical point, or _NO_SAMPLE_COUNT
+    slope : float, phase increment per sample
+    in_lock : int, remaining lockdown samples
+    sign_mask : int, last num_to_wait derivative signs as bits, newest in the lowest bit
+    full_mask : int, (1 << num_to_wait) - 1
+    derv_bar, gradient_factor, reset_on, reset_threshold, lock_on, lockdown : PM parameters
+
+    Returns
+    -------
+    tuple of (curr_phase, curr_sign, sample_count, slope, in_lock, sign_mask)
+    """
+    # Update lock counter
+    if in_lock > 0:
+        in_lock -= 1
+
+    # Extrapolate current phase
+    if sample_count != _NO_SAMPLE_COUNT:
+        curr_phase = sample_count * slope
+    else:
+        curr_phase = 0.0
+
+    # Update sign buffer
+    new_sign = 1 if curr_derv > 0 else 0
+    sign_mask = ((sign_mask << 1) | new_sign) & full_mask
+
+    # Increment sample count
+    if sample_count != _NO_SAMPLE_COUNT:
+        sample_count += 1
+
+    # Check for critical point/reset conditions
+    # All signs opposite to the current one: no bits set while waiting for a peak,
+    # all bits set while waiting for a trough
+    if_flip = (sign_mask == (1 - curr_sign) * full_mask
+               and abs(curr_derv) >= derv_bar)
+    if_force = (reset_on and sample_count != _NO_SAMPLE_COUNT
+                and sample_count >= reset_threshold)
+
+    # Critical point / reset logic
+    if (if_flip or if_force) and in_lock == 0:
+        curr_phase = curr_sign * np.pi
+
+        if sample_count != _NO_SAMPLE_COUNT:
+            if curr_sign:
+                slope = (2 - curr_sign) * np.pi / sample_count
+            else:
+                slope = (2 - curr_sign) * np.pi / (sample_count / gradient_factor)
+                in_lock = lockdown * lock_on
+
+        sample_count = curr_sign * int(np.pi / slope)
+
+        curr_sign = 1 - curr_sign
+        sign_mask = curr_sign * full_mask
+
+    return curr_phase, curr_sign, sample_count, slope, in_lock, sign_mask
 
 
 class PMEstimator(PhaseEstimator):
     """Phase Mapping estimator"""
     
-    def __init__(self, sos, regr_buffer_size=50, num_to_wait=10, 
+    def __init__(self, sos, center_freq, fs, regr_buffer_size=50, num_to_wait=10,
                  derv_bar=0.01, default_slope=0.012, gradient_factor=1,
                  reset_on=False, reset_threshold=250, lock_on=False, lockdown=50):
         self.sos = sos
@@ -118,111 +483,112 @@ class PMEstimator(PhaseEstimator):
         self.lockdown = lockdown
         
         # Initialize state variables
-        self.A = self._generate_matrix(regr_buffer_size)
-        self.sign_buffer = [True] * num_to_wait
+        # Least-squares slope over a sliding window of x = 0..n-1 from running sums of
+        # y and x*y; the sums of x and x^2 never change
+        n = regr_buffer_size
+        self._regr_axis = np.arange(n, dtype=np.float64)
+        self._sum_x = n * (n - 1) / 2
+        self._regr_denominator = n * (n - 1) * n * (2 * n - 1) / 6 - self._sum_x ** 2
+        self._sum_y = 0.0
+        self._sum_xy = 0.0
+        # Regression buffer as a ring: the oldest sample sits at _ring_head
+        self._ring = np.empty(n, dtype=np.float32)
+        self._ring_head = 0
+        self._ring_filled = False
+        # Last num_to_wait derivative signs packed into the bits of one integer
+        assert 0 < num_to_wait < 63, 'num_to_wait must be between 1 and 62'
+        self._full_sign_mask = (1 << num_to_wait) - 1
+        self._sign_mask = self._full_sign_mask
         self.curr_sign = True
-        self.sample_count = None
-        self.slope = default_slope
+        self.sample_count = _NO_SAMPLE_COUNT
+        self.slope = float(default_slope)
         self.in_lock = 0
-        self.prev_filtered_buffer = None
+        self.phase_lag = _passband_phase_lag(sos, center_freq, fs)
+        self._filter = _StreamingSOSFilter(sos)
+        self._curr_phase = None
     
-    def _generate_matrix(self, size):
+    def _sync_regression_sums(self):
+        """
+        Recompute the running regression sums exactly, discarding rounding drift;
+        only valid when the ring is in chronological order (_ring_head == 0)
         """
-        Generate matrix for linear regression (linear algebra method)
+        self._sum_y = float(np.sum(self._ring, dtype=np.float64))
+        self._sum_xy = float(np.dot(self._regr_axis, self._ring))
+
+    def _push_filtered_sample(self, sample):
+        """
+        Slide the regression buffer by one sample and update the running sums in O(1)
 
         Parameters
         ----------
-        size : int, size of matrix created for regression
+        sample : float, newest filtered sample
+        """
+        sample = float(sample)
+        oldest = float(self._ring[self._ring_head])
+        # Every remaining sample moves one step left on the x axis
+        self._sum_xy += (self.regr_buffer_size - 1) * sample - self._sum_y + oldest
+        self._sum_y += sample - oldest
+
+        # Overwrite the oldest sample
+        self._ring[self._ring_head] = sample
+        self._ring_head = (self._ring_head + 1) % self.regr_buffer_size
+
+        # Once per pass around the ring the buffer is back in order
+        if self._ring_head == 0:
+            self._sync_regression_sums()
+
+    def _calculate_derivative(self):
+        """
+        Calculate derivative / linear regression slope of the regression buffer
 
         Returns
         -------
-        A : 2-dimensional numpy array that represents matrix for linear regression
+        float, derivative / slope of the regression line
         """
-        sampling_axis = np.arange(size)
-        A = np.vstack([sampling_axis, np.ones(len(sampling_axis))]).T
-        return A
-
-    def _calculate_derivative(self, buffer):
+        n = self.regr_buffer_size
+        return (n * self._sum_xy - self._sum_x * self._sum_y) / self._regr_denominator
+    
+    def _update_state(self, curr_derv):
         """
-        Calculate derivative / linear regression with linear algebra
+        Advance the PM state machine by one sample
 
         Parameters
         ----------
-        buffer : list or array of values for linear regression
+        curr_derv : float, derivative of the filtered signal at the current sample
 
         Returns
         -------
-        float, derivative / slope of the regression line
+        float, extrapolated phase in [0, 2π]
         """
-        curr_regr = buffer[:, np.newaxis]
-        pinv = np.linalg.pinv(self.A)
-        alpha = pinv.dot(curr_regr)
-        return alpha[0][0]
-    
-    def _force_reset(self):
-        """Check if force reset is needed"""
-        if not self.reset_on or self.sample_count is None:
-            return False
-        return self.sample_count >= self.reset_threshold
-    
-    def estimate_phase(self, data_window, **kwargs):
+        (curr_phase, curr_sign, self.sample_count, self.slope, self.in_lock,
+         self._sign_mask) = _pm_update(
+            float(curr_derv), int(self.curr_sign), self.sample_count, self.slope, self.in_lock,
+            self._sign_mask, self._full_sign_mask, float(self.derv_bar),
+            float(self.gradient_factor), bool(self.reset_on), int(self.reset_threshold),
+            int(self.lock_on), int(self.lockdown)
+        )
+        self.curr_sign = bool(curr_sign)
+        return curr_phase
+
+    def estimate_phase(self, data_window, num_new=1, **kwargs):
         """Estimate phase using Phase Mapping method"""
-        # Filter the data - maintain buffer for derivative calculation
-        filtered = sosfiltfilt(self.sos, data_window)
-        
-        # Update filtered buffer for regression
-        if self.prev_filtered_buffer is None:
-            self.prev_filtered_buffer = filtered[-self.regr_buffer_size:]
-        else:
-            # Append new sample and maintain buffer size
-            self.prev_filtered_buffer = np.concatenate([
-                self.prev_filtered_buffer[1:], 
-                [filtered[-1]]
-            ])
-        
-        # Calculate derivative
-        curr_derv = self._calculate_derivative(self.prev_filtered_buffer)
-        
-        # Update lock counter
-        if self.in_lock > 0:
-            self.in_lock -= 1
-        
-        # Extrapolate current phase
-        if self.sample_count is not None:
-            curr_phase = self.sample_count * self.slope
+        # Filter only the new samples, the filter state carries over between calls
+        filtered = self._filter.filter_new(data_window, num_new)
+        if len(filtered) == 0:
+            return self._curr_phase
+
+        if not self._ring_filled:
+            # First call: regress on the tail of the filtered window
+            self._ring[:] = filtered[-self.regr_buffer_size:]
+            self._ring_filled = True
+            self._sync_regression_sums()
+            curr_phase = self._update_state(self._calculate_derivative())
         else:
-            curr_phase = 0
-        
-        # Update sign buffer
-        self.sign_buffer.append(curr_derv > 0)
-        self.sign_buffer.pop(0)
-        
-        # Increment sample count
-        if self.sample_count is not None:
-            self.sample_count += 1
-        
-        # Check for critical point/reset conditions
-        if_flip = (self.curr_sign + sum(self.sign_buffer) / self.num_to_wait == 1 
-                   and np.abs(curr_derv) >= self.derv_bar)
-        if_force = self._force_reset()
-        
-        # Critical point / reset logic
-        if (if_flip or if_force) and self.in_lock == 0:
-            curr_phase = self.curr_sign * np.pi
-            
-            if self.sample_count is not None:
-                if self.curr_sign:
-                    self.slope = (2 - self.curr_sign) * np.pi / self.sample_count
-                else:
-                    self.slope = (2 - self.curr_sign) * np.pi / (self.sample_count / self.gradient_factor)
-                    self.in_lock = self.lockdown * self.lock_on
-                
-                self.sample_count = self.curr_sign * int(np.pi / self.slope)
-            else:
-                self.sample_count = self.curr_sign * int(np.pi / self.slope)
-            
-            self.curr_sign = not self.curr_sign
-            self.sign_buffer = [self.curr_sign] * self.num_to_wait
+            for sample in filtered:
+                self._push_filtered_sample(sample)
+                curr_phase = self._update_state(self._calculate_derivative())
         
-        # Convert from [0, 2π] to [-π, π] range to match other methods
-        return curr_phase % (2 * np.pi) - np.pi if curr_phase is not None else 0
\ No newline at end of file
+        # Compensate the causal filter's phase lag, then convert from [0, 2π] to [-π, π]
+        # range to match other methods
+        self._curr_phase = (curr_phase + self.phase_lag) % (2 * np.pi) - np.pi
+        return self._curr_phase
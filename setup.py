@@ -8,13 +8,16 @@ setuptools.setup(
     description='Trodes-based closed loop control system; process multiple window sizes in parallel',
     url='https://bitbucket.org/EMK_Lab/clc/src/master/',
     packages=setuptools.find_packages(),
+    python_requires='>=3.8',
     install_requires=[
         'numpy',
         'scipy',
+        'numba',
         'matplotlib',
         'ipython',
         'nbformat',
         'trodesnetwork==0.0.11',
+        'pyzmq',
         'argparse'
     ],
 )